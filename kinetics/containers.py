@@ -2,24 +2,38 @@
 
 __author__ = 'Timotej Bernat'
 
-from typing import Optional, Union
-from dataclasses import dataclass, field
+from typing import Any, Optional, Union
+import sys
+from collections import Counter
+from dataclasses import dataclass, field, fields
 
 import json
+import pickle
 from pathlib import Path
 
 
-@dataclass
-class ElementaryReaction:
+class _ReactionCache:
+    '''Slots for values cached on reactions, kept out of the dataclass fields so that they're excluded from comparisons, asdict(), and astuple()'''
+    __slots__ = ('_rate_expression', '_hash')
+
+@dataclass(frozen=True, slots=True) # NOTE: frozen, since reactions are hashed by value and cache their hash; use dataclasses.replace() to derive modified reactions
+class ElementaryReaction(_ReactionCache):
     '''For representing a single reactant -> product change in a human-readable format'''
-    reactants : list[str]
-    products  : list[str]
+    reactants : tuple[str, ...]
+    products  : tuple[str, ...]
     rate_const_value : float
     rate_const_key : str = 'k'
 
     name : str = ''
     scaling_group_id : Optional[int] = None
 
+    def __post_init__(self) -> None:
+        object.__setattr__(self, '_rate_expression', None) # NOTE: frozen instances can only be initialized (and cached values set) through object.__setattr__()
+        object.__setattr__(self, '_hash', None)
+
+        object.__setattr__(self, 'reactants', tuple(sys.intern(str(species)) for species in self.reactants)) # accept any sequence of species, but store as immutable tuples...
+        object.__setattr__(self, 'products',  tuple(sys.intern(str(species)) for species in self.products))  # ...of interned names (speeds up repeated comparison and hashing)
+
     def create_reverse_reaction(self, k_rev_value : float, k_rev_key : Optional[str]=None, rev_name : Optional[str]=None, default_suffix : str='rev') -> 'ElementaryReaction': 
         '''Generates the corresponding reverse reaction given a reverse rate constant'''
         if k_rev_key is None: # TOSELF: worth making reverse rate constant VALUE default to that of forward as well? (might encourage redundant/lazy definitions)
@@ -45,7 +59,9 @@ class ElementaryReaction:
     @property
     def rate_expression(self) -> str:
         '''Generate algebraic rate equation for the current reaction step'''
-        return "*".join([self.rate_const_key] + self.reactants)
+        if self._rate_expression is None: # NOTE: cached in a slot, since functools.cached_property is incompatible with __slots__
+            object.__setattr__(self, '_rate_expression', f'{self.rate_const_key}*{"*".join(self.reactants)}' if self.reactants else self.rate_const_key)
+        return self._rate_expression
 
     def reaction_expression(self, spacing_width : int=1, species_sep : str='+', arrow_stem : str='=', arrow_head : str='>', arrow_seg_len : int=2) -> str:
         '''Generate symbolic representation of the current reaction'''
@@ -64,51 +80,88 @@ class ElementaryReaction:
         return self.reaction_expression()
     
     def __hash__(self) -> int:
-        return hash(self.reaction_expression())
+        if self._hash is None: # avoid rebuilding reaction string every time the reaction is placed in a set or dict
+            object.__setattr__(self, '_hash', hash(self.reaction_expression()))
+        return self._hash
     
     # file I/O
+    def to_dict(self) -> dict[str, Any]:
+        '''Dict of the values needed to reconstruct the current reaction (cached values are not dataclass fields, so are excluded)'''
+        return {fld.name : getattr(self, fld.name) for fld in fields(self)}
+
+    def __reduce__(self) -> tuple[type, tuple]:
+        '''Pickle (and copy) reactions from their defining values only, so cached values aren't stored with every reaction'''
+        return (self.__class__, tuple(self.to_dict().values()))
+
     def to_file(self, save_path : Union[Path, str], indent : int=4) -> None:
-        '''Save the current reaction to a file on disc'''
+        '''
+        Save the current reaction to a file on disc, in a format determined by the file's suffix:
+        .json (human-readable), .pkl (fastest, Python-only), or .msgpack (compact binary, requires msgpack)
+        '''
         if isinstance(save_path, str):
             save_path = Path(save_path)
-        assert(save_path.suffix) == '.json' # only allow saving to JSON files for now
 
-        with save_path.open('w') as file:
-            json.dump(self.__dict__, file, indent=indent)
+        if save_path.suffix == '.json':
+            with save_path.open('w') as file:
+                json.dump(self.to_dict(), file, indent=indent)
+        elif save_path.suffix == '.pkl':
+            with save_path.open('wb') as file:
+                pickle.dump(self, file, protocol=5)
+        elif save_path.suffix == '.msgpack':
+            import msgpack # NOTE: imported here, since msgpack is an optional dependency only needed for this format
+            with save_path.open('wb') as file:
+                file.write(msgpack.packb(self.to_dict()))
+        else:
+            raise ValueError(f'Unsupported reaction file format "{save_path.suffix}" (must be one of .json, .pkl, or .msgpack)')
 
     @classmethod
     def from_file(cls, load_path : Union[Path, str]) -> 'ElementaryReaction':
-        '''Load a reaction from a saved reaction file on disc'''
+        '''Load a reaction from a saved reaction file on disc, in any of the formats supported by to_file()'''
         if isinstance(load_path, str):
             load_path = Path(load_path)
 
         assert(load_path.exists())
-        with load_path.open('r') as file:
-            return cls(**json.load(file))
-
-@dataclass
+        if load_path.suffix == '.json':
+            with load_path.open('r') as file:
+                return cls(**json.load(file))
+        elif load_path.suffix == '.pkl':
+            with load_path.open('rb') as file:
+                rxn = pickle.load(file)
+            if not isinstance(rxn, cls):
+                raise TypeError(f'Pickled object in {load_path} is a {type(rxn).__name__}, not a {cls.__name__}')
+            return rxn
+        elif load_path.suffix == '.msgpack':
+            import msgpack
+            with load_path.open('rb') as file:
+                return cls(**msgpack.unpackb(file.read()))
+        else:
+            raise ValueError(f'Unsupported reaction file format "{load_path.suffix}" (must be one of .json, .pkl, or .msgpack)')
+
+@dataclass(slots=True)
 class StoichBalanceTerms:
-    '''For encapsulating info about which material balance terms a transformation occurs in'''
-    generation  : set[ElementaryReaction] = field(default_factory=set)
-    consumption : set[ElementaryReaction] = field(default_factory=set)
-    # flow_in  : set = field(default_factory=set) # may be worth including if flow/species removal terms are needed
-    # flow_out : set = field(default_factory=set)
+    '''For encapsulating info about which material balance terms a transformation occurs in, and how many times (i.e. the stoichiometric coefficient)'''
+    generation  : Counter[ElementaryReaction] = field(default_factory=Counter)
+    consumption : Counter[ElementaryReaction] = field(default_factory=Counter)
+    # flow_in  : Counter = field(default_factory=Counter) # may be worth including if flow/species removal terms are needed
+    # flow_out : Counter = field(default_factory=Counter)
 
     @property
     def signed_rxns(self) -> list[tuple[int, ElementaryReaction]]:
-        '''Returns all contributing reactions and their sign when inserted into a rate expression'''
-        return [(1, rxn) for rxn in self.generation] + [(-1, rxn) for rxn in self.consumption]
+        '''Returns all contributing reactions and their signed stoichiometric coefficient when inserted into a rate expression'''
+        return [(count, rxn) for rxn, count in self.generation.items()] + [(-count, rxn) for rxn, count in self.consumption.items()]
 
     @staticmethod
-    def _int_to_sign_str(sign_int : int) -> str:
-        if sign_int not in (1, -1):
+    def _int_to_coeff_str(coeff_int : int) -> str:
+        if coeff_int == 0:
             raise ValueError
-        return '-' if (sign_int == -1) else ''
+        sign_str = '-' if (coeff_int < 0) else ''
+        mult_str = f'{abs(coeff_int)}*' if (abs(coeff_int) != 1) else ''
+        return f'{sign_str}{mult_str}'
 
     @property
     def rate_expression(self) -> str:
         '''Generate symbolic rate equation describing the species balance'''
-        return ' + '.join(self._int_to_sign_str(sign_int)+rxn.rate_expression for sign_int, rxn in self.signed_rxns)
+        return ' + '.join(self._int_to_coeff_str(coeff_int)+rxn.rate_expression for coeff_int, rxn in self.signed_rxns)
 
     @property
     def expressions(self) -> list[tuple[float, str]]:
@@ -5,60 +5,157 @@ __author__ = 'Timotej Bernat'
 import logging
 LOGGER = logging.getLogger(__name__)
 
-from typing import Sequence
-from collections import defaultdict
+from typing import Sequence, TypeAlias, Union
+from collections import Counter, defaultdict
+from itertools import permutations
 
 import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix
 
 from .containers import ElementaryReaction, StoichBalanceTerms
 
+StoichSystem : TypeAlias = tuple[csr_matrix, np.ndarray, np.ndarray, np.ndarray] # stoichiometry matrix, rate constants, packed reactant indices, and reactant offsets
 
-def compile_reaction_network(rxns : Sequence[ElementaryReaction]) -> tuple[dict[str, float], dict[str, StoichBalanceTerms], dict[int, str]]:
+
+def compile_reaction_network(rxns : Sequence[ElementaryReaction]) -> tuple[dict[str, float], dict[str, StoichBalanceTerms], dict[str, int]]:
     '''
     Collect unique reactants and rate constants among a collection of reactions
     Returns a dict of rate const key-value pairs, a dict of stoichiometric contributions keyed by species,
-    and a dict of unique indices for each species
+    and a dict of unique indices for each species (in the order species are first encountered)
     '''
-    rate_consts : dict[str, float] = {}
-    contributing_terms  = defaultdict(StoichBalanceTerms)
+    rate_consts : dict[str, float] = {rxn.rate_const_key : rxn.rate_const_value for rxn in rxns} # TODO: scale this by scaling group, if requested?
+    if len(rate_consts) < len(rxns): # at least one rate constant key is repeated; only search for the offending reaction in this (rare) case
+        rate_const_keys_seen : set[str] = set()
+        for rxn in rxns:
+            if rxn.rate_const_key in rate_const_keys_seen:
+                raise KeyError(f'Duplicate rate constant "{rxn.rate_const_key}={rxn.rate_const_value}" defined in reaction: {str(rxn)}')
+            rate_const_keys_seen.add(rxn.rate_const_key)
     
     SPECIES_BY_CONTRIB : dict[str, str] = {
         'generation' :  'products',  # species is considered "generated" if appearing in the products...
         'consumption' : 'reactants', # ...and "consumed if it appears as one of the products"
     }
-    for rxn in rxns:
-        # register rate constant
-        if rxn.rate_const_key in rate_consts:
-            raise KeyError(f'Duplicate rate constant "{rxn.rate_const_key}={rxn.rate_const_value}" defined in reaction: {str(rxn)}')
-        rate_consts[rxn.rate_const_key] = rxn.rate_const_value # TODO: scale this by scaling group, if requested?
-        
-        # register participating species
+    rxns_by_contrib : dict[str, dict[str, list[ElementaryReaction]]] = defaultdict(lambda : {balance_type : [] for balance_type in SPECIES_BY_CONTRIB}) # accumulate into lists, deferring hashing until all reactions are collected
+    for rxn in rxns: # register participating species
         for balance_type, species_list_type in SPECIES_BY_CONTRIB.items():
             for species in getattr(rxn, species_list_type):
-                getattr(contributing_terms[species], balance_type).add(rxn)
-    contributing_terms = dict(contributing_terms) # convert to vanilla dict for simplicity after collecting all reactants
+                rxns_by_contrib[species][balance_type].append(rxn)
+
+    contributing_terms : dict[str, StoichBalanceTerms] = { # tally only once all reactions are collected; repeat occurrences (e.g. of A in A + A -> S) give the stoichiometric coefficient, so must be counted rather than discarded
+        species : StoichBalanceTerms(**{balance_type : Counter(contrib_rxns) for balance_type, contrib_rxns in rxns_by_balance_type.items()})
+            for species, rxns_by_balance_type in rxns_by_contrib.items()
+    }
+
+    idxs_by_species = {species : i for i, species in enumerate(contributing_terms)}
+
+    return rate_consts, contributing_terms, idxs_by_species
 
-    return rate_consts, contributing_terms
+def compute_rate_const_tensors(contributing_terms : dict[str, StoichBalanceTerms], idxs_by_species : dict[str, int], scaling_groups : dict[int, float], sparse : bool=False, dtype : type=np.float64) -> dict[int, Union[np.ndarray[float], csr_matrix]]:
+    '''
+    Generate tensors of rate constants for each reaction order, such that dC/dt = K @ C + sum_jk K2_ijk C_j C_k
+    If sparse=True, tensors are returned as scipy.sparse CSR matrices, with the 2nd-order tensor flattened to shape (n_species, n_species**2)
+    Passing dtype=np.float32 halves the memory footprint of the tensors, at the cost of precision (rate constants spanning many orders of magnitude may lose accuracy)
 
-def compute_rate_const_tensors(contributing_terms : dict[str, StoichBalanceTerms], idxs_by_species : dict[str, int], scaling_groups : dict[int, float]) -> dict[int, np.ndarray[float]]:
-    '''Generate tensors of '''
+    NOTE: the two forms hold different (but equivalent) 2nd-order tensors. The dense K2 is symmetric in its reactant axes (i.e. K2_ijk == K2_ikj),
+    whereas the sparse K2 stores each pair of reactants only once, under its sorted (upper-triangular, j <= k) ordering; therefore,
+    K2_sparse.toarray().reshape(n_species, n_species, n_species) does NOT in general equal the dense K2, though both give the same sum_jk K2_ijk C_j C_k
+    '''
     n_species = len(idxs_by_species)
-    rate_const_tensors_by_order = {
-        1 : np.zeros((n_species, n_species), dtype=float),
-        2 : np.zeros((n_species, n_species, n_species), dtype=float), # NOTE: for now, do not support any reactions beyond 1st and 2nd order
+    SHAPES_BY_ORDER : dict[int, tuple[int, ...]] = { # NOTE: for now, do not support any reactions beyond 1st and 2nd order
+        1 : (n_species, n_species),
+        2 : (n_species, n_species, n_species),
+    }
+    entries_by_order : dict[int, tuple[list[tuple[int, ...]], list[float]]] = { # collect only nonzero entries (as indices and values), rather than filling (mostly empty) dense tensors directly
+        order : ([], [])
+            for order in SHAPES_BY_ORDER
     }
 
+    reactant_idxs_by_rxn : dict[ElementaryReaction, tuple[int, ...]] = {} # translate species names of each reaction only once, rather than once for every species balance it appears in
+    log_rate_expressions : bool = LOGGER.isEnabledFor(logging.INFO) # skip building rate expression strings entirely if they won't be logged
     for species, sbt in contributing_terms.items():
-        LOGGER.info(f'{species} : {sbt.rate_expression}')
+        if log_rate_expressions:
+            LOGGER.info(f'{species} : {sbt.rate_expression}')
         curr_spec_idx = idxs_by_species[species]
 
-        for sign, rxn in sbt.signed_rxns:
+        for stoich_coeff, rxn in sbt.signed_rxns: # signed coefficient, so that repeated species (e.g. A in A + A -> S) contribute once per occurrence
             order = rxn.order
-            reactant_idxs = [idxs_by_species[s] for s in rxn.reactants] # index of each species (corresponds to the rate of change of conc of this species)
-            if (rate_const_tensor := rate_const_tensors_by_order.get(order)) is None:
+            if (entries := entries_by_order.get(order)) is None:
                 LOGGER.warn(f'Reactions of {order=} are currently unsupported, will be skipped when building system of rate equations')
+                continue
+            if (reactant_idxs := reactant_idxs_by_rxn.get(rxn)) is None: # index of each species (corresponds to the rate of change of conc of this species)
+                reactant_idxs = reactant_idxs_by_rxn[rxn] = tuple(idxs_by_species[species] for species in rxn.reactants)
             
             scale_factor = scaling_groups.get(rxn.scaling_group_id, 1.0) # default to scale factor of 1.0 (i.e. no scaling) if no scale factor group is assigned
-            rate_const_tensor[curr_spec_idx, *reactant_idxs] = sign * scale_factor * rxn.rate_const_value
+            rate_const = stoich_coeff * scale_factor * rxn.rate_const_value
+
+            entry_idxs, entry_vals = entries
+            if sparse: # store each product of concentrations only once, under its sorted (i.e. upper-triangular) reactant ordering
+                entry_idxs.append((curr_spec_idx, *sorted(reactant_idxs)))
+                entry_vals.append(rate_const)
+            else: # split evenly over all distinct orderings of reactants, so dense tensors are symmetric in their reactant axes (i.e. K2_ijk == K2_ikj)
+                reactant_orderings = set(permutations(reactant_idxs))
+                for reactant_ordering in reactant_orderings:
+                    entry_idxs.append((curr_spec_idx, *reactant_ordering))
+                    entry_vals.append(rate_const / len(reactant_orderings))
+
+    rate_const_tensors_by_order = {}
+    for order, (entry_idxs, entry_vals) in entries_by_order.items():
+        shape = SHAPES_BY_ORDER[order]
+        idxs = tuple(np.array(entry_idxs, dtype=int).reshape(-1, len(shape)).T) # one array of indices along each tensor axis
+        vals = np.array(entry_vals, dtype=dtype)
+
+        # NOTE: entries with repeated indices (e.g. for a species which is both generated and consumed by one reaction) are summed, not overwritten,
+        # so each entry's net value matches the corresponding (net) coefficient of the stoichiometry matrix from build_arrays()
+        if sparse: # flatten all reactant axes into a single column index, i.e. a rank-2 (N, N**order) matrix
+            row_idxs, col_idxs = idxs[0], np.ravel_multi_index(idxs[1:], shape[1:])
+            rate_const_tensors_by_order[order] = coo_matrix((vals, (row_idxs, col_idxs)), shape=(shape[0], int(np.prod(shape[1:])))).tocsr() # duplicates are summed upon conversion
+        else:
+            rate_const_tensor = np.zeros(shape, dtype=dtype)
+            np.add.at(rate_const_tensor, idxs, vals)
+            rate_const_tensors_by_order[order] = rate_const_tensor
+
+    return rate_const_tensors_by_order
+
+def build_arrays(rxns : Sequence[ElementaryReaction], idxs_by_species : dict[str, int], scaling_groups : dict[int, float]) -> StoichSystem:
+    '''
+    Generate the stoichiometric form dC/dt = Nmat @ r(C) of a reaction network as flat arrays, where r_j = k_j * prod(C[reactant_idxs_j])
+    Returns the sparse (n_species x n_rxns) stoichiometry matrix, the vector of (scaled) rate constants of each reaction,
+    the species indices of the reactants of all reactions packed contiguously, and the offsets into these at which the reactants of each reaction begin
+    (i.e. the reactants of the j-th reaction are reactant_idx_flat[reactant_offsets[j]:reactant_offsets[j+1]])
+    '''
+    n_rxns = len(rxns)
+    k_vec = np.fromiter((rxn.rate_const_value for rxn in rxns), dtype=np.float64, count=n_rxns)
+    k_vec *= np.fromiter((scaling_groups.get(rxn.scaling_group_id, 1.0) for rxn in rxns), dtype=np.float64, count=n_rxns) # default to scale factor of 1.0 (i.e. no scaling) if no scale factor group is assigned
+
+    # pack species of all reactions into single ragged (CSR-style) arrays; this is the only per-species pass made in Python
+    n_reactants = np.fromiter((len(rxn.reactants) for rxn in rxns), dtype=np.int32, count=n_rxns)
+    n_products  = np.fromiter((len(rxn.products)  for rxn in rxns), dtype=np.int32, count=n_rxns)
+    reactant_offsets = np.zeros(n_rxns + 1, dtype=np.int32)
+    np.cumsum(n_reactants, out=reactant_offsets[1:])
+
+    all_species = np.array([species for rxn in rxns for species in rxn.reactants] + [species for rxn in rxns for species in rxn.products], dtype=str)
+    species_unique, species_inverse = np.unique(all_species, return_inverse=True) # translate names to indices with one lookup per unique species, rather than per occurrence
+    unique_species_idxs = np.array([idxs_by_species[species] for species in species_unique], dtype=np.int32)
+    all_species_idxs = unique_species_idxs[species_inverse.reshape(-1)]
+    reactant_idx_flat = all_species_idxs[:reactant_offsets[-1]]
+
+    rxn_idxs = np.arange(n_rxns, dtype=np.int32)
+    stoich_matrix = coo_matrix( # duplicate entries are summed, so repeated species and catalysts (i.e. both generated and consumed) net out correctly
+        (
+            np.concatenate([np.full(reactant_offsets[-1], -1.0), np.ones(len(all_species_idxs) - reactant_offsets[-1])]), # reactants are consumed, products are generated
+            (all_species_idxs, np.concatenate([np.repeat(rxn_idxs, n_reactants), np.repeat(rxn_idxs, n_products)])),
+        ),
+        shape=(len(idxs_by_species), n_rxns),
+    ).tocsr()
+    stoich_matrix.eliminate_zeros() # drop entries for species which net out entirely
+
+    return stoich_matrix, k_vec, reactant_idx_flat, reactant_offsets
+
+def compile_stoich_system(contributing_terms : dict[str, StoichBalanceTerms], idxs_by_species : dict[str, int], scaling_groups : dict[int, float]) -> StoichSystem:
+    '''Generate the stoichiometric form of a reaction network from per-species balance terms, with one column for each unique reaction (see build_arrays())'''
+    unique_rxns : dict[ElementaryReaction, None] = {} # dict (rather than set) to preserve order in which reactions are encountered
+    for sbt in contributing_terms.values():
+        for _, rxn in sbt.signed_rxns:
+            unique_rxns.setdefault(rxn)
 
-    return rate_const_tensors_by_order
\ No newline at end of file
+    return build_arrays(list(unique_rxns), idxs_by_species=idxs_by_species, scaling_groups=scaling_groups)
\ No newline at end of file
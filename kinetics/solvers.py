@@ -2,29 +2,328 @@
 
 __author__ = 'Timotej Bernat'
 
-from typing import TypeAlias, TypeVar
+from typing import Callable, Optional, Sequence, TypeAlias, TypeVar
+from functools import lru_cache, partial
+from concurrent.futures import ProcessPoolExecutor
 Shape : TypeAlias = tuple
 N = TypeVar('N')
 
 import numpy as np
-from scipy.integrate import solve_ivp
+from scipy.integrate import ode, solve_ivp
 from scipy.integrate._ivp.ivp import OdeResult
+from scipy.sparse import csr_matrix, issparse
 
+from .containers import ElementaryReaction
+from .reactions import StoichSystem, build_arrays
 
-def integrate_reaction_network(init_nonzero_concs : dict[str, float], rate_const_tensors : dict[int, np.ndarray], idxs_by_species : dict[str, int], t0 : float=0.0, tf : float=10.0, **options) -> OdeResult:
-    '''Solve system of ODEs for processed reaction network. Returns the SciPy ODEResult object containing all solutions'''
-    n_species = len(idxs_by_species)
-    init_concs = np.zeros(n_species, dtype=float) # initialize all concentrations to 0 M
+try:
+    from numba import njit
+    NUMBA_AVAILABLE : bool = True
+except ImportError: # numba is optional; integration will fall back to (slower) pure NumPy time step functions
+    NUMBA_AVAILABLE : bool = False
+
+JACOBIAN_METHODS : frozenset[str] = frozenset({'Radau', 'BDF', 'LSODA'}) # integration methods available to solve_ivp() which make use of a Jacobian
+ODE_INTEGRATORS  : frozenset[str] = frozenset({'lsoda', 'vode'}) # Fortran integrators available through scipy.integrate.ode, which copy (rather than hold onto) returned derivatives
+SOLVE_IVP_ONLY_OPTIONS : frozenset[str] = frozenset({'dense_output', 'events', 'vectorized', 'args', 'jac_sparsity'}) # options of solve_ivp() which have no counterpart in scipy.integrate.ode
+
+
+def _mass_action_kernel(k_vec : np.ndarray, reactant_idx_flat : np.ndarray, reactant_offsets : np.ndarray, stoich_indptr : np.ndarray, stoich_indices : np.ndarray, stoich_data : np.ndarray, rxn_rates : np.ndarray, t : float, C : np.ndarray[Shape[N], float]) -> np.ndarray[Shape[N], float]:
+    '''
+    Explicit-loop evaluation of dC/dt = Nmat @ r(C), for reactant indices and offsets packed as by build_arrays()
+    and the stoichiometry matrix Nmat given by the (indptr, indices, data) arrays of its CSR representation
+    Network arrays come first and (t, C) last, so that binding the former with functools.partial() yields a valid ODE time step function
+    '''
+    n_species, n_rxns = len(stoich_indptr) - 1, len(k_vec)
+    for j in range(n_rxns):
+        r_j = k_vec[j]
+        for p in range(reactant_offsets[j], reactant_offsets[j+1]):
+            r_j *= C[reactant_idx_flat[p]]
+        rxn_rates[j] = r_j
+
+    dCdt = np.zeros(n_species, dtype=C.dtype) # NOTE: deliberately not a reused buffer, as solvers hold onto previously-returned derivatives
+    for i in range(n_species):
+        for p in range(stoich_indptr[i], stoich_indptr[i+1]):
+            dCdt[i] += stoich_data[p] * rxn_rates[stoich_indices[p]]
+
+    return dCdt
+
+def _mass_action_jacobian_kernel(k_vec : np.ndarray, reactant_idx_flat : np.ndarray, reactant_offsets : np.ndarray, stoich_indptr : np.ndarray, stoich_indices : np.ndarray, stoich_data : np.ndarray, t : float, C : np.ndarray[Shape[N], float]) -> np.ndarray[Shape[N, N], float]:
+    '''
+    Explicit-loop evaluation of the Jacobian J = Nmat @ dr/dC, with reactant arrays in the same layout as for _mass_action_kernel()
+    but with the stoichiometry matrix Nmat given by the (indptr, indices, data) arrays of its CSC (rather than CSR) representation,
+    so that each derivative dr_j/dC_m can be scattered directly into the species which reaction j changes
+    '''
+    n_species, n_rxns = len(C), len(k_vec)
+    jac = np.zeros((n_species, n_species), dtype=C.dtype)
+    for j in range(n_rxns):
+        for p in range(reactant_offsets[j], reactant_offsets[j+1]): # differentiate w.r.t. each reactant in turn...
+            dr_j = k_vec[j]
+            for q in range(reactant_offsets[j], reactant_offsets[j+1]):
+                if q != p: # ...leaving the product of the concentrations of all other reactants
+                    dr_j *= C[reactant_idx_flat[q]]
+
+            m = reactant_idx_flat[p]
+            for s in range(stoich_indptr[j], stoich_indptr[j+1]): # J_im += Nmat_ij * dr_j/dC_m, for only those species i which participate in reaction j
+                jac[stoich_indices[s], m] += stoich_data[s] * dr_j
+
+    return jac
+
+if NUMBA_AVAILABLE:
+    _mass_action_kernel = njit(cache=True, fastmath=True)(_mass_action_kernel)
+    _mass_action_jacobian_kernel = njit(cache=True, fastmath=True)(_mass_action_jacobian_kernel)
+
+def _generate_mass_action_source(stoich_system : StoichSystem, func_name : str='law_of_mass_action') -> str:
+    '''
+    Emit Python source for a straight-line (i.e. loop-free) time step function f(k, t, C) specialized to the structure of a particular reaction network
+    Rate constants are read from the vector k rather than written into the source, so that networks differing only in their rate constants share the same source
+    '''
+    stoich_matrix, k_vec, reactant_idx_flat, reactant_offsets = stoich_system
+    n_species = stoich_matrix.shape[0]
+
+    lines = [f'def {func_name}(k, t, C):']
+    for j in range(len(k_vec)):
+        conc_factors = ''.join(f'*C[{i}]' for i in reactant_idx_flat[reactant_offsets[j]:reactant_offsets[j+1]])
+        lines.append(f'    r{j} = k[{j}]{conc_factors}')
+
+    lines.append(f'    dCdt = np.empty({n_species})')
+    for i in range(n_species):
+        terms = []
+        for j, coeff in zip(stoich_matrix.indices[stoich_matrix.indptr[i]:stoich_matrix.indptr[i+1]], stoich_matrix.data[stoich_matrix.indptr[i]:stoich_matrix.indptr[i+1]]):
+            sign_str = '-' if coeff < 0 else '+'
+            coeff_str = '' if abs(coeff) == 1.0 else f'{float(abs(coeff))!r}*'
+            terms.append(f'{sign_str} {coeff_str}r{j}')
+        lines.append(f'    dCdt[{i}] = {" ".join(terms).removeprefix("+ ") if terms else "0.0"}')
+    lines.append('    return dCdt')
+
+    return '\n'.join(lines)
+
+@lru_cache(maxsize=32) # NOTE: bounded, since each compiled function (and its numba dispatcher) is held for as long as it's cached
+def _compile_generated_source(source : str, func_name : str='law_of_mass_action', jit : bool=NUMBA_AVAILABLE) -> Callable:
+    '''Execute generated function source, caching compiled results so networks of identical structure are only ever compiled once'''
+    namespace = {'np' : np}
+    exec(compile(source, f'<generated {func_name}>', 'exec'), namespace)
+    func = namespace[func_name]
+    if jit:
+        func = njit(fastmath=True)(func) # NOTE: can't cache to disc, since generated functions have no source file
+
+    return func
+
+def codegen_rhs(rxns : Sequence[ElementaryReaction], idxs_by_species : dict[str, int], scaling_groups : dict[int, float], jit : bool=NUMBA_AVAILABLE) -> Callable:
+    '''Generate a time step function f(t, C) -> dC/dt specialized to a collection of reactions, JIT-compiled with numba if requested'''
+    stoich_system = build_arrays(rxns, idxs_by_species, scaling_groups)
+    return partial(_compile_generated_source(_generate_mass_action_source(stoich_system), jit=jit), stoich_system[1]) # bind rate constants, which aren't part of the generated source
+
+def initial_concentrations(init_nonzero_concs : dict[str, float], idxs_by_species : dict[str, int]) -> np.ndarray[Shape[N], float]:
+    '''Generate full vector of initial concentrations, with all species whose concentration is not explicitly given initialized to 0 M'''
+    init_concs = np.zeros(len(idxs_by_species), dtype=float) # initialize all concentrations to 0 M
     for species, c0 in init_nonzero_concs.items():
         i = idxs_by_species[species]
         init_concs[i] = c0 # set non-zero concs by passed values
 
+    return init_concs
+
+def _solve_mass_action_odes(law_of_mass_action : Callable, jacobian : Callable, init_concs : np.ndarray[Shape[N], float], t0 : float, tf : float, **options) -> OdeResult:
+    '''Integrate a system of mass action ODEs, supplying the analytic Jacobian to any method which can make use of it (defaults to LSODA)'''
+    method = options.setdefault('method', 'LSODA')
+    if method in ODE_INTEGRATORS:
+        return _integrate_with_ode(law_of_mass_action, jacobian, init_concs, t0=t0, tf=tf, integrator=options.pop('method'), **options)
+
+    if getattr(method, '__name__', method) in JACOBIAN_METHODS: # explicit methods warn if passed an unused Jacobian
+        options.setdefault('jac', jacobian)
+
+    return solve_ivp(law_of_mass_action, t_span=[t0, tf], y0=init_concs, **options)
+
+def _read_only_view(arr : np.ndarray) -> np.ndarray:
+    '''Read-only view of an array, which guards against accidental modification without locking the original array (which may belong to the caller)'''
+    view = arr.view()
+    view.flags.writeable = False
+
+    return view
+
+def _integrate_with_ode(law_of_mass_action : Callable, jacobian : Callable, init_concs : np.ndarray[Shape[N], float], t0 : float, tf : float, integrator : str='lsoda', t_eval : Optional[np.ndarray]=None, **integrator_params) -> OdeResult:
+    '''
+    Integrate a system of ODEs with one of the integrators of scipy.integrate.ode, reporting solutions at the times in t_eval
+    (by default, 101 evenly-spaced times from t0 to tf) in the same form as solve_ivp() for compatibility
+    As for solve_ivp(), passing jac replaces the analytic Jacobian (jac=None has the integrator estimate it by finite differences instead)
+    '''
+    if (unsupported_options := SOLVE_IVP_ONLY_OPTIONS.intersection(integrator_params)):
+        raise ValueError(f'Option(s) {", ".join(sorted(unsupported_options))} are only supported by solve_ivp() methods, not by the "{integrator}" integrator of scipy.integrate.ode')
+    jacobian = integrator_params.pop('jac', jacobian)
+    if not ((jacobian is None) or callable(jacobian)):
+        raise ValueError(f'Jacobian passed to the "{integrator}" integrator of scipy.integrate.ode must be a callable jac(t, C) or None, not a {type(jacobian).__name__}')
+
+    if t_eval is None:
+        t_eval = np.linspace(t0, tf, 101)
+
+    eval_counts = [0, 0] # number of derivative and Jacobian evaluations, respectively; counted here, since scipy.integrate.ode only reports these through private attributes
+    def counted_law_of_mass_action(t : float, C : np.ndarray[Shape[N], float]) -> np.ndarray[Shape[N], float]:
+        eval_counts[0] += 1
+        return law_of_mass_action(t, C)
+
+    def counted_jacobian(t : float, C : np.ndarray[Shape[N], float]) -> np.ndarray[Shape[N, N], float]:
+        eval_counts[1] += 1
+        return jacobian(t, C)
+
+    solver = ode(counted_law_of_mass_action, None if (jacobian is None) else counted_jacobian).set_integrator(integrator, **integrator_params)
+    solver.set_initial_value(init_concs, t0)
+
+    concs = np.empty((len(init_concs), len(t_eval)), dtype=float)
+    n_solved = 0
+    for t in t_eval:
+        concs[:, n_solved] = solver.y if (t == solver.t) else solver.integrate(t)
+        if not solver.successful():
+            break
+        n_solved += 1
+    success = (n_solved == len(t_eval))
+
+    return OdeResult(
+        t=t_eval[:n_solved],
+        y=concs[:, :n_solved],
+        sol=None,
+        t_events=None,
+        y_events=None,
+        nfev=eval_counts[0],
+        njev=eval_counts[1],
+        nlu=0,
+        status=(0 if success else -1),
+        message=('Integration successful.' if success else f'Integration step failed (return code {solver.get_return_code()}).'),
+        success=success,
+    )
+
+def integrate_reaction_network(init_nonzero_concs : dict[str, float], rate_const_tensors : dict[int, np.ndarray], idxs_by_species : dict[str, int], t0 : float=0.0, tf : float=10.0, dtype : Optional[type]=None, **options) -> OdeResult:
+    '''
+    Solve system of ODEs for processed reaction network. Returns the SciPy ODEResult object containing all solutions
+    Integrates with LSODA (using the analytic Jacobian) unless another method is specified
+    Passing method='lsoda' or 'vode' integrates with scipy.integrate.ode instead, at the times given by t_eval
+
+    Time step functions are evaluated in the given dtype (by default, that of the rate constant tensors)
+    For reduced precision (e.g. np.float32), looser default tolerances of rtol=1E-5 and atol=1E-6 are used unless otherwise specified;
+    note that the solver state itself remains in float64, and that stiff networks may integrate poorly (or fail) at reduced precision
+    '''
+    n_species = len(idxs_by_species)
+    init_concs = initial_concentrations(init_nonzero_concs, idxs_by_species)
+
+    # Define ODE time step function
+    K  = rate_const_tensors[1] # bind tensors once here, rather than performing dict lookups on every step
+    K2 = rate_const_tensors[2]
+    if dtype is None:
+        dtype = np.result_type(K.dtype, K2.dtype)
+    else:
+        K, K2 = K.astype(dtype, copy=False), K2.astype(dtype, copy=False)
+
+    if np.finfo(dtype).eps > np.finfo(np.float64).eps: # tolerances tighter than the working precision can't be met
+        options.setdefault('rtol', 1E-5)
+        options.setdefault('atol', 1E-6)
+
+    if issparse(K2): # 2nd-order tensor is stored flattened to shape (N, N**2)
+        K2_coo = K2.tocoo()
+        K2_rows, (K2_cols_j, K2_cols_k), K2_vals = K2_coo.row, np.divmod(K2_coo.col, n_species), K2_coo.data # recover both reactant indices from flattened column index
+
+        def law_of_mass_action(t : float, C : np.ndarray[Shape[N], float]) -> np.ndarray[Shape[N], float]:
+            C = np.ascontiguousarray(C, dtype=dtype) # NOTE: solve_ivp always passes float64 concentrations, which may also be non-contiguous slices
+            K2_terms = K2_vals * C[K2_cols_j] * C[K2_cols_k] # gather only the concentration products which are actually needed, rather than forming all N**2 of them
+
+            return K.dot(C) + np.bincount(K2_rows, weights=K2_terms, minlength=n_species) # sum contributions from first and second-order rxns, respectively
+
+        K_dense = _read_only_view(np.ascontiguousarray(K.toarray() if issparse(K) else K, dtype=dtype))
+
+        def jacobian(t : float, C : np.ndarray[Shape[N], float]) -> np.ndarray[Shape[N, N], float]:
+            C = np.ascontiguousarray(C, dtype=dtype)
+            jac = K_dense.copy()
+            np.add.at(jac, (K2_rows, K2_cols_j), K2_vals * C[K2_cols_k]) # J_ij = K_ij + sum_k (K2_ijk + K2_ikj) C_k
+            np.add.at(jac, (K2_rows, K2_cols_k), K2_vals * C[K2_cols_j])
+
+            return jac
+    else:
+        K  = _read_only_view(np.ascontiguousarray(K.toarray() if issparse(K) else K, dtype=dtype)) # contiguous, constant operands let np.dot() take its BLAS fast paths
+        tri_j, tri_k = np.triu_indices(n_species) # since C_j*C_k == C_k*C_j, only pairs with j <= k need be contracted
+        K2_tri = K2[:, tri_j, tri_k] + K2[:, tri_k, tri_j] # fold both orderings of each pair into a single triangular term, shape (N, N*(N+1)/2)
+        K2_tri[:, tri_j == tri_k] *= 0.5 # diagonal terms were counted twice by the fold
+        K2_tri.flags.writeable = False
+        C_j, C_k = np.empty(len(tri_j), dtype=dtype), np.empty(len(tri_k), dtype=dtype) # reusable buffers for the gathered concentrations of each pair
+        K2_contrib = np.empty(n_species, dtype=dtype) # reusable buffer for the contributions of second-order rxns
+        dCdt_out = np.empty(n_species, dtype=dtype) if (options.get('method') in ODE_INTEGRATORS) else None # derivatives can only be written to a reused buffer if the integrator copies them
+        pair_derivs = csr_matrix( # derivatives of each pairwise product C_j*C_k w.r.t. C_j and C_k (duplicate entries of diagonal pairs are summed, giving 2*C_j)
+            (np.empty(2*len(tri_j), dtype=dtype), np.column_stack([tri_j, tri_k]).ravel(), np.arange(0, 2*len(tri_j) + 1, 2)),
+            shape=(len(tri_j), n_species),
+        ) # NOTE: sparsity pattern is fixed, so only its values need be refreshed on each evaluation
+
+        def law_of_mass_action(t : float, C : np.ndarray[Shape[N], float]) -> np.ndarray[Shape[N], float]:
+            C = np.ascontiguousarray(C, dtype=dtype) # NOTE: solve_ivp always passes float64 concentrations, which may also be non-contiguous slices
+            np.take(C, tri_j, out=C_j)
+            np.take(C, tri_k, out=C_k)
+            np.multiply(C_j, C_k, out=C_j) # upper triangle of all pairwise products of concentrations
+            dCdt = np.empty(n_species, dtype=dtype) if (dCdt_out is None) else dCdt_out
+            np.dot(K, C, out=dCdt) # contributions from first-order rxns...
+            np.dot(K2_tri, C_j, out=K2_contrib)
+            dCdt += K2_contrib # ...plus those from second-order rxns, accumulated in-place
+
+            return dCdt
+
+        def jacobian(t : float, C : np.ndarray[Shape[N], float]) -> np.ndarray[Shape[N, N], float]:
+            C = np.ascontiguousarray(C, dtype=dtype)
+            pair_derivs.data[0::2] = C[tri_k] # d(C_j*C_k)/dC_j...
+            pair_derivs.data[1::2] = C[tri_j] # ...and d(C_j*C_k)/dC_k
+
+            return K + K2_tri @ pair_derivs # J_ij = K_ij + sum_k (K2_ijk + K2_ikj) C_k, by the chain rule through the triangular pairwise products
+
+    return _solve_mass_action_odes(law_of_mass_action, jacobian, init_concs, t0=t0, tf=tf, **options)
+
+def integrate_stoich_system(init_nonzero_concs : dict[str, float], stoich_system : StoichSystem, idxs_by_species : dict[str, int], t0 : float=0.0, tf : float=10.0, codegen : bool=False, **options) -> OdeResult:
+    '''
+    Solve system of ODEs for a reaction network in stoichiometric form. Returns the SciPy ODEResult object containing all solutions
+    Integrates with LSODA (using the analytic Jacobian) unless another method is specified
+    If codegen=True, the time step function is generated as straight-line code specialized to the reaction network
+    '''
+    init_concs = initial_concentrations(init_nonzero_concs, idxs_by_species)
+    stoich_matrix, k_vec, reactant_idx_flat, reactant_offsets = stoich_system
+
     # Define ODE time step function
-    def law_of_mass_action(t : float, C : np.ndarray[Shape[N], float], rate_const_tensors : dict[int, np.ndarray]) -> np.ndarray[Shape[N], float]:
-        K  = rate_const_tensors[1]
-        K2 = rate_const_tensors[2]
-        C2 = np.outer(C, C) # captures every possible pairwise product of cocentrations
+    if NUMBA_AVAILABLE:
+        stoich_arrays = (stoich_matrix.indptr, stoich_matrix.indices, stoich_matrix.data) # raw CSR arrays, which can be passed to JIT-compiled kernels
+        rxn_rates = np.empty(len(k_vec), dtype=float) # reusable buffer for the rate of each reaction
+
+        stoich_matrix_csc = stoich_matrix.tocsc() # Jacobian is scattered column-wise (i.e. reaction-by-reaction), for which CSC is the natural layout
+        stoich_arrays_csc = (stoich_matrix_csc.indptr, stoich_matrix_csc.indices, stoich_matrix_csc.data)
+
+        # NOTE: binding arrays with partial() (rather than wrapping calls in a closure) means the solver calls
+        # straight into the compiled dispatcher, without an intermediate Python frame on every evaluation
+        law_of_mass_action = partial(_mass_action_kernel, k_vec, reactant_idx_flat, reactant_offsets, *stoich_arrays, rxn_rates)
+        jacobian = partial(_mass_action_jacobian_kernel, k_vec, reactant_idx_flat, reactant_offsets, *stoich_arrays_csc)
+    else:
+        reactant_idx_list = np.split(reactant_idx_flat, reactant_offsets[1:-1]) # unpack reactant indices for each reaction once, ahead of integration
+        has_reactants = (reactant_offsets[:-1] < reactant_offsets[1:]) # reduceat() can't form empty products, so reactions with no reactants (i.e. zeroth order) must be masked out
+        reactant_starts = reactant_offsets[:-1][has_reactants]
+
+        def law_of_mass_action(t : float, C : np.ndarray[Shape[N], float]) -> np.ndarray[Shape[N], float]:
+            conc_prods = np.ones(len(k_vec), dtype=float)
+            conc_prods[has_reactants] = np.multiply.reduceat(C[reactant_idx_flat], reactant_starts) # product of reactant concentrations for all reactions in a single pass
+            rxn_rates = k_vec * conc_prods # rate of each reaction, i.e. r_j = k_j * prod(C[reactant_idxs_j])
+
+            return stoich_matrix.dot(rxn_rates) # rates of change of each species are the stoichiometrically-weighted sum of reaction rates
+
+        def jacobian(t : float, C : np.ndarray[Shape[N], float]) -> np.ndarray[Shape[N, N], float]:
+            rxn_rate_derivs = np.zeros((len(k_vec), len(C)), dtype=float)
+            for j, reactant_idxs in enumerate(reactant_idx_list):
+                for p, m in enumerate(reactant_idxs): # dr_j/dC_m is the rate with the concentration of the m-th reactant omitted
+                    rxn_rate_derivs[j, m] += k_vec[j] * np.delete(C[reactant_idxs], p).prod()
+
+            return stoich_matrix.dot(rxn_rate_derivs)
+
+    if codegen: # replace generic time step function with one specialized to the given network
+        law_of_mass_action = partial(_compile_generated_source(_generate_mass_action_source(stoich_system), jit=NUMBA_AVAILABLE), k_vec)
+
+    return _solve_mass_action_odes(law_of_mass_action, jacobian, init_concs, t0=t0, tf=tf, **options)
 
-        return np.dot(K, C) + np.tensordot(K2, C2) # sum contributions from first and second-order rxns, respectively
+def batch_integrate(init_nonzero_concs_list : Sequence[dict[str, float]], rate_const_tensors_list : Sequence[dict[int, np.ndarray]], idxs_by_species : dict[str, int], t0 : float=0.0, tf : float=10.0, max_workers : Optional[int]=None, **options) -> list[OdeResult]:
+    '''
+    Solve a batch of independent reaction networks (e.g. a sweep over initial concentrations or rate constants) in parallel worker processes
+    The i-th network is integrated from the i-th set of initial concentrations with the i-th set of rate constant tensors; all other options
+    are as for integrate_reaction_network(), and must be picklable. Returns the ODEResult of each network, in the order given
+    '''
+    if len(init_nonzero_concs_list) != len(rate_const_tensors_list):
+        raise ValueError(f'Must provide one set of rate constant tensors per set of initial concentrations (got {len(rate_const_tensors_list)} and {len(init_nonzero_concs_list)}, respectively)')
 
-    return solve_ivp(law_of_mass_action, t_span=[t0, tf], y0=init_concs, args=(rate_const_tensors,), **options)
\ No newline at end of file
+    integrate = partial(integrate_reaction_network, idxs_by_species=idxs_by_species, t0=t0, tf=tf, **options) # NOTE: module-level function is picklable, unlike the time step closures it builds
+    with ProcessPoolExecutor(max_workers=max_workers) as executor: # processes rather than threads, since the time step functions hold the GIL
+        return list(executor.map(integrate, init_nonzero_concs_list, rate_const_tensors_list))
\ No newline at end of file